@@ -1,5 +1,17 @@
 import openai
 import os
+import shutil
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# Shared HTTP session so repeated downloads reuse pooled connections
+SESSION = requests.Session()
+SESSION.mount("https://", HTTPAdapter(
+    pool_connections=10,
+    pool_maxsize=10,
+    max_retries=Retry(total=3, backoff_factor=0.5, status_forcelist=[429, 500, 502, 503, 504]),
+))
 
 # Get user input
 image_path = "" # enter the base image file path 
@@ -29,12 +41,13 @@ try:
     image_url = response['data'][0]['url']
     print(f"Generated image URL: {image_url}")
 
-    # Download and save the image
-    import requests
-    img_data = requests.get(image_url).content
+    # Download and stream the image straight to disk
     output_path = "generated_image.png"
-    with open(output_path, 'wb') as handler:
-        handler.write(img_data)
+    with SESSION.get(image_url, stream=True, timeout=30) as r:
+        r.raise_for_status()
+        r.raw.decode_content = True
+        with open(output_path, 'wb') as handler:
+            shutil.copyfileobj(r.raw, handler)
     print(f"Generated image saved as {output_path}")
 except Exception as e:
     print(f"Error processing response: {e}")
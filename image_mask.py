@@ -1,8 +1,9 @@
 import os
+import mmap
 import json 
 import requests
 from openai import OpenAI
-import base64
+import pybase64
 
 client = OpenAI()
 
@@ -16,8 +17,10 @@ def create_file(file_path):
     return result.id
 
 def encode_image(file_path):
+    # Encode straight from the page cache instead of copying the file into memory
     with open(file_path, "rb") as f:
-        base64_image = base64.b64encode(f.read()).decode("utf-8")
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            base64_image = pybase64.b64encode(mm).decode("utf-8")
     return base64_image
 
 
@@ -65,4 +68,4 @@ image_data = [
 if image_data:
     image_base64 = image_data[0]
     with open("lounge.png", "wb") as f:
-        f.write(base64.b64decode(image_base64))
\ No newline at end of file
+        f.write(pybase64.b64decode(image_base64))
\ No newline at end of file
@@ -1,13 +1,21 @@
 import streamlit as st
 import os
-import json
+import time
 import requests
-from openai import OpenAI
-import base64
-import tempfile
-from pathlib import Path
-import io
-from PIL import Image
+import pybase64
+from streamlit_common import (
+    DEFAULT_MAX_EDGE,
+    GENERATION_POLL_INTERVAL,
+    build_batch_request,
+    file_cache_key,
+    get_executor,
+    get_openai_client,
+    prepare_upload,
+    render_batch_panel,
+    run_generation,
+    schedule_file_cleanup,
+    validate_image_file_cached,
+)
 
 # Page configuration
 st.set_page_config(
@@ -17,48 +25,110 @@ st.set_page_config(
     initial_sidebar_state="expanded"
 )
 
-# Initialize OpenAI client
-@st.cache_resource
-def get_openai_client():
-    return OpenAI()
+def create_file(client, upload):
+    """Create a file in OpenAI for vision processing from a (filename, bytes, mime_type) tuple."""
+    result = client.files.create(
+        file=upload,
+        purpose="vision",
+    )
+    return result.id
 
-def create_file(file_path):
-    """Create a file in OpenAI for vision processing."""
-    client = get_openai_client()
-    with open(file_path, "rb") as file_content:
-        result = client.files.create(
-            file=file_content,
-            purpose="vision",
-        )
-        return result.id
+def get_file_id(client, uploaded_file, max_edge):
+    """Upload a file unless this session already uploaded the same content."""
+    file_id_cache = st.session_state.setdefault("file_id_cache", {})
+    cache_key = file_cache_key(uploaded_file, max_edge)
+    if cache_key not in file_id_cache:
+        file_id_cache[cache_key] = create_file(client, prepare_upload(uploaded_file, max_edge))
+    return file_id_cache[cache_key]
 
-def encode_image(file_path):
-    """Encode image to base64."""
-    with open(file_path, "rb") as f:
-        base64_image = base64.b64encode(f.read()).decode("utf-8")
-    return base64_image
+def build_request_body(prompt, base_file_id, mask_file_id, quality):
+    """Build the Responses API request body for a masked image generation call."""
+    return {
+        "model": "gpt-4o",
+        "input": [
+            {
+                "role": "user",
+                "content": [
+                    {
+                        "type": "input_text",
+                        "text": prompt,
+                    },
+                    {
+                        "type": "input_image",
+                        "file_id": base_file_id,
+                    }
+                ],
+            },
+        ],
+        "tools": [
+            {
+                "type": "image_generation",
+                "quality": quality,
+                "input_image_mask": {
+                    "file_id": mask_file_id,
+                },
+            },
+        ],
+    }
 
-def validate_image_file(uploaded_file):
-    """Validate uploaded image file."""
-    if uploaded_file is None:
-        return False, "No file uploaded"
-    
-    # Check file size (max 20MB for OpenAI)
-    if uploaded_file.size > 20 * 1024 * 1024:
-        return False, "File size must be less than 20MB"
+def render_generation_result(api_key, keep_uploads, output_filename, save_to_disk):
+    """Show the result of the background generation, polling until it finishes."""
+    future = st.session_state.get("generation_future")
+    if future is not None:
+        if not future.done():
+            st.info("🔄 Generating your masked image...")
+            time.sleep(GENERATION_POLL_INTERVAL)
+            st.rerun()
+        
+        # Rerun with the finished future set aside so the generate button is enabled again
+        st.session_state["generation_done"] = st.session_state.pop("generation_future")
+        file_ids = st.session_state.pop("generation_file_ids", [])
+        if not keep_uploads:
+            schedule_file_cleanup(api_key, file_ids)
+        st.rerun()
     
-    # Check file type
-    allowed_types = ['image/jpeg', 'image/jpg', 'image/png', 'image/gif', 'image/webp']
-    if uploaded_file.type not in allowed_types:
-        return False, f"File type {uploaded_file.type} not supported. Use: {', '.join(allowed_types)}"
+    # The result is shown once, then dropped from session state
+    future = st.session_state.pop("generation_done", None)
+    if future is None:
+        return
+    try:
+        image_data, response = future.result()
+    except Exception as e:
+        st.error(f"❌ Error: {str(e)}")
+        st.exception(e)
+        return
     
-    return True, "File is valid"
-
-def save_uploaded_file(uploaded_file):
-    """Save uploaded file to temporary location."""
-    with tempfile.NamedTemporaryFile(delete=False, suffix=f".{uploaded_file.name.split('.')[-1]}") as tmp_file:
-        tmp_file.write(uploaded_file.getvalue())
-        return tmp_file.name
+    if image_data:
+        st.success("✅ Masked image generated successfully!")
+        
+        # Display and save generated image
+        st.subheader("🎨 Generated Masked Image")
+        
+        image_base64 = image_data[0]
+        image_bytes = pybase64.b64decode(image_base64)
+        
+        # Display image
+        st.image(image_bytes, caption="Generated Masked Image", use_column_width=True)
+        
+        # Download button
+        st.download_button(
+            label="📥 Download Masked Image",
+            data=image_bytes,
+            file_name=output_filename,
+            mime="image/png"
+        )
+        
+        # Save to file
+        if save_to_disk:
+            with open(output_filename, "wb") as f:
+                f.write(image_bytes)
+            st.info(f"💾 Image also saved as: {output_filename}")
+        
+    else:
+        st.error("❌ No image was generated")
+        if hasattr(response.output, 'content'):
+            st.text("API Response:")
+            st.text(response.output.content)
 
 def main():
     st.title("🎭 AI Image Masking")
@@ -83,8 +153,29 @@ def main():
             st.info("Please enter your API key in the sidebar or set the OPENAI_API_KEY environment variable.")
             return
         
-        # Set API key for client
-        os.environ["OPENAI_API_KEY"] = api_key
+        client = get_openai_client(api_key)
+        
+        # Batch mode
+        batch_mode = st.toggle(
+            "Batch mode",
+            help="Queue requests and submit them as one batch job. Costs about half as much but results can take up to 24 hours."
+        )
+        
+        # Uploaded file cleanup
+        keep_uploads = st.toggle(
+            "Keep uploads",
+            help="Keep uploaded images on OpenAI after generation so repeat runs can reuse them. When off, they are deleted once the result arrives."
+        )
+        
+        # Image preprocessing
+        max_edge = st.slider(
+            "Max image edge (px)",
+            min_value=256,
+            max_value=4096,
+            value=DEFAULT_MAX_EDGE,
+            step=128,
+            help="Larger images are downscaled to this size before upload. Lower values upload faster; higher values keep more detail."
+        )
         
         # Quality selection
         quality = st.selectbox(
@@ -135,7 +226,7 @@ def main():
         
         if base_image is not None:
             # Validate base image
-            is_valid, message = validate_image_file(base_image)
+            is_valid, message = validate_image_file_cached(base_image.name, base_image.size, base_image.type)
             if is_valid:
                 st.success(f"✅ Base image: {message}")
                 st.image(base_image, caption="Base Image", use_column_width=True)
@@ -153,7 +244,7 @@ def main():
         
         if mask_image is not None:
             # Validate mask image
-            is_valid, message = validate_image_file(mask_image)
+            is_valid, message = validate_image_file_cached(mask_image.name, mask_image.size, mask_image.type)
             if is_valid:
                 st.success(f"✅ Mask image: {message}")
                 st.image(mask_image, caption="Mask Image", use_column_width=True)
@@ -184,8 +275,16 @@ def main():
             help="Name for the generated image file"
         )
         
+        # Optional local copy
+        save_to_disk = st.checkbox(
+            "Also save to disk",
+            help="Write the generated image to the output filename on the server in addition to offering it for download"
+        )
+        
         # Generate button
-        if st.button("🚀 Generate Masked Image", type="primary", disabled=not (base_image and mask_image and prompt)):
+        button_label = "➕ Add to Batch" if batch_mode else "🚀 Generate Masked Image"
+        generating = "generation_future" in st.session_state
+        if st.button(button_label, type="primary", disabled=generating or not (base_image and mask_image and prompt)):
             if not base_image:
                 st.error("Please upload a base image!")
                 return
@@ -198,101 +297,30 @@ def main():
             
             try:
                 with st.spinner("🔄 Processing your masked image..."):
-                    # Save uploaded files temporarily
-                    temp_files = []
+                    # Create file IDs for OpenAI, reusing earlier uploads
+                    base_file_id = get_file_id(client, base_image, max_edge)
+                    mask_file_id = get_file_id(client, mask_image, max_edge)
                     
-                    try:
-                        # Save base image
-                        base_path = save_uploaded_file(base_image)
-                        temp_files.append(base_path)
-                        
-                        # Save mask image
-                        mask_path = save_uploaded_file(mask_image)
-                        temp_files.append(mask_path)
-                        
-                        # Create file IDs for OpenAI
-                        base_file_id = create_file(base_path)
-                        mask_file_id = create_file(mask_path)
-                        
-                        # Make API call
-                        client = get_openai_client()
-                        response = client.responses.create(
-                            model="gpt-4o",
-                            input=[
-                                {
-                                    "role": "user",
-                                    "content": [
-                                        {
-                                            "type": "input_text",
-                                            "text": prompt,
-                                        },
-                                        {
-                                            "type": "input_image",
-                                            "file_id": base_file_id,
-                                        }
-                                    ],
-                                },
-                            ],
-                            tools=[
-                                {
-                                    "type": "image_generation",
-                                    "quality": quality,
-                                    "input_image_mask": {
-                                        "file_id": mask_file_id,
-                                    },
-                                },
-                            ],
-                        )
-                        
-                        # Extract image generation results
-                        image_data = [
-                            output.result
-                            for output in response.output
-                            if output.type == "image_generation_call"
-                        ]
-                        
-                        if image_data:
-                            st.success("✅ Masked image generated successfully!")
-                            
-                            # Display and save generated image
-                            st.subheader("🎨 Generated Masked Image")
-                            
-                            image_base64 = image_data[0]
-                            image_bytes = base64.b64decode(image_base64)
-                            
-                            # Display image
-                            st.image(image_bytes, caption="Generated Masked Image", use_column_width=True)
-                            
-                            # Download button
-                            st.download_button(
-                                label="📥 Download Masked Image",
-                                data=image_bytes,
-                                file_name=output_filename,
-                                mime="image/png"
-                            )
-                            
-                            # Save to file
-                            with open(output_filename, "wb") as f:
-                                f.write(image_bytes)
-                            st.info(f"💾 Image also saved as: {output_filename}")
-                            
-                        else:
-                            st.error("❌ No image was generated")
-                            if hasattr(response.output, 'content'):
-                                st.text("API Response:")
-                                st.text(response.output.content)
+                    body = build_request_body(prompt, base_file_id, mask_file_id, quality)
                     
-                    finally:
-                        # Clean up temporary files
-                        for temp_file in temp_files:
-                            try:
-                                os.unlink(temp_file)
-                            except:
-                                pass
-                        
+                    if batch_mode:
+                        # Queue the request for the next batch submission
+                        batch_queue = st.session_state.setdefault("batch_queue", [])
+                        custom_id = f"request-{len(batch_queue) + 1}"
+                        batch_queue.append(build_batch_request(custom_id, body))
+                        st.session_state.setdefault("batch_file_ids", set()).update([base_file_id, mask_file_id])
+                        st.success(f"✅ Added {custom_id} to the batch queue")
+                    else:
+                        # Run the API call in the background so the UI stays responsive
+                        st.session_state["generation_future"] = get_executor().submit(run_generation, client, body)
+                        st.session_state["generation_file_ids"] = [base_file_id, mask_file_id]
+            
             except Exception as e:
                 st.error(f"❌ Error: {str(e)}")
                 st.exception(e)
+        
+        render_generation_result(api_key, keep_uploads, output_filename, save_to_disk)
+        render_batch_panel(client, api_key, keep_uploads)
     
     # Footer
     st.markdown("---")
@@ -5,21 +5,18 @@ Uses GPT-4 Vision with image masking capabilities.
 """
 
 import subprocess
+import importlib.util
 import sys
 import os
 
 def check_dependencies():
     """Check if required packages are installed."""
-    required_packages = ['streamlit', 'openai', 'requests', 'PIL']
+    required_packages = ['streamlit', 'openai', 'requests', 'PIL', 'pybase64']
     missing_packages = []
     
+    # find_spec only locates the package, without importing it
     for package in required_packages:
-        try:
-            if package == 'PIL':
-                import PIL
-            else:
-                __import__(package)
-        except ImportError:
+        if importlib.util.find_spec(package) is None:
             missing_packages.append(package)
     
     if missing_packages:
@@ -1,13 +1,28 @@
 import streamlit as st
 import os
-import json
+import asyncio
+import time
 import requests
-from openai import OpenAI
-import base64
-import tempfile
-from pathlib import Path
-import io
-from PIL import Image
+from openai import APIConnectionError, APIStatusError, RateLimitError
+import pybase64
+import math
+from PIL import Image, ImageDraw, ImageOps
+from streamlit_common import (
+    DEFAULT_MAX_EDGE,
+    GENERATION_POLL_INTERVAL,
+    build_batch_request,
+    create_async_client,
+    open_image,
+    encode_png_upload,
+    file_cache_key,
+    get_executor,
+    get_openai_client,
+    prepare_upload,
+    render_batch_panel,
+    run_generation,
+    schedule_file_cleanup,
+    validate_image_file_cached,
+)
 
 # Page configuration
 st.set_page_config(
@@ -17,48 +32,178 @@ st.set_page_config(
     initial_sidebar_state="expanded"
 )
 
-# Initialize OpenAI client
-@st.cache_resource
-def get_openai_client():
-    return OpenAI()
+# Upload pipeline limits
+MAX_CONCURRENT_UPLOADS = 5
+UPLOAD_MAX_ATTEMPTS = 3
+UPLOAD_RETRY_BASE_DELAY = 1  # seconds, doubled after each failed attempt
 
-def create_file(file_path):
-    """Create a file in OpenAI for vision processing."""
-    client = get_openai_client()
-    with open(file_path, "rb") as file_content:
-        result = client.files.create(
-            file=file_content,
-            purpose="vision",
-        )
-        return result.id
+# Reference image splicing
+SPLICE_CELL_SIZE = 512  # pixels per tile in the composite grid
+SPLICE_COLUMNS = 2
+
+def is_retryable_error(error):
+    """Return True for rate limit, server and connection errors worth retrying."""
+    if isinstance(error, (RateLimitError, APIConnectionError)):
+        return True
+    return isinstance(error, APIStatusError) and error.status_code >= 500
+
+async def create_file_async(client, upload):
+    """Create a file in OpenAI for vision processing, retrying transient failures.
+    
+    upload is a (filename, bytes, mime_type) tuple as returned by prepare_upload.
+    """
+    for attempt in range(UPLOAD_MAX_ATTEMPTS):
+        try:
+            result = await client.files.create(
+                file=upload,
+                purpose="vision",
+            )
+            return result.id
+        except Exception as e:
+            if attempt == UPLOAD_MAX_ATTEMPTS - 1 or not is_retryable_error(e):
+                raise
+            await asyncio.sleep(UPLOAD_RETRY_BASE_DELAY * 2 ** attempt)
+
+async def process_uploaded_file_async(client, semaphore, uploaded_file, max_edge, file_id_cache):
+    """Prepare and upload one file while holding a pipeline slot.
+    
+    Files whose content was already uploaded in this session reuse the cached file ID.
+    """
+    cache_key = await asyncio.to_thread(file_cache_key, uploaded_file, max_edge)
+    if cache_key in file_id_cache:
+        return file_id_cache[cache_key]
+    
+    async with semaphore:
+        upload = await asyncio.to_thread(prepare_upload, uploaded_file, max_edge)
+        file_id = await create_file_async(client, upload)
+    
+    file_id_cache[cache_key] = file_id
+    return file_id
 
-def encode_image(file_path):
-    """Encode image to base64."""
-    with open(file_path, "rb") as f:
-        base64_image = base64.b64encode(f.read()).decode("utf-8")
-    return base64_image
+async def upload_composite_async(api_key, upload):
+    """Upload a single spliced composite image."""
+    async with create_async_client(api_key) as client:
+        return await create_file_async(client, upload)
 
-def validate_image_file(uploaded_file):
-    """Validate uploaded image file."""
-    if uploaded_file is None:
-        return False, "No file uploaded"
+async def prepare_images_async(api_key, uploaded_files, max_edge, file_id_cache):
+    """Prepare and upload all files through a bounded concurrent pipeline.
     
-    # Check file size (max 20MB for OpenAI)
-    if uploaded_file.size > 20 * 1024 * 1024:
-        return False, "File size must be less than 20MB"
+    Returns the file IDs in the same order as uploaded_files.
+    """
+    # The semaphore and client are created per run so they bind to this event loop
+    semaphore = asyncio.Semaphore(MAX_CONCURRENT_UPLOADS)
+    async with create_async_client(api_key) as client:
+        file_ids = await asyncio.gather(*[
+            process_uploaded_file_async(client, semaphore, uploaded_file, max_edge, file_id_cache)
+            for uploaded_file in uploaded_files
+        ])
+    return list(file_ids)
+
+def splice_images(pil_images, cols=SPLICE_COLUMNS):
+    """Tile images into one numbered grid, in order, left to right and top to bottom."""
+    cols = min(cols, len(pil_images))
+    rows = math.ceil(len(pil_images) / cols)
+    composite = Image.new("RGB", (cols * SPLICE_CELL_SIZE, rows * SPLICE_CELL_SIZE), "white")
+    draw = ImageDraw.Draw(composite)
     
-    # Check file type
-    allowed_types = ['image/jpeg', 'image/jpg', 'image/png', 'image/gif', 'image/webp']
-    if uploaded_file.type not in allowed_types:
-        return False, f"File type {uploaded_file.type} not supported. Use: {', '.join(allowed_types)}"
+    for index, image in enumerate(pil_images):
+        tile = ImageOps.exif_transpose(image).convert("RGBA")
+        tile.thumbnail((SPLICE_CELL_SIZE, SPLICE_CELL_SIZE), Image.LANCZOS)
+        
+        # Center the tile in its cell
+        cell_x = (index % cols) * SPLICE_CELL_SIZE
+        cell_y = (index // cols) * SPLICE_CELL_SIZE
+        offset = (
+            cell_x + (SPLICE_CELL_SIZE - tile.width) // 2,
+            cell_y + (SPLICE_CELL_SIZE - tile.height) // 2,
+        )
+        composite.paste(tile, offset, tile)
+        
+        # Number the tile in its top-left corner
+        draw.rectangle((cell_x, cell_y, cell_x + 28, cell_y + 28), fill="black")
+        draw.text((cell_x + 10, cell_y + 8), str(index + 1), fill="white")
     
-    return True, "File is valid"
+    return composite
+
+def prepare_spliced_upload(uploaded_files):
+    """Splice uploaded reference images into one composite PNG upload tuple."""
+    images = [open_image(uploaded_file) for uploaded_file in uploaded_files]
+    return encode_png_upload(splice_images(images), "references.png")
 
-def save_uploaded_file(uploaded_file):
-    """Save uploaded file to temporary location."""
-    with tempfile.NamedTemporaryFile(delete=False, suffix=f".{uploaded_file.name.split('.')[-1]}") as tmp_file:
-        tmp_file.write(uploaded_file.getvalue())
-        return tmp_file.name
+def build_request_body(prompt, file_ids):
+    """Build the Responses API request body for an image generation call."""
+    content = [{"type": "input_text", "text": prompt}]
+    
+    # Add uploaded images to content
+    for file_id in file_ids:
+        content.append({
+            "type": "input_image",
+            "file_id": file_id,
+        })
+    
+    return {
+        "model": "gpt-4o",
+        "input": [
+            {
+                "role": "user",
+                "content": content,
+            }
+        ],
+        "tools": [{"type": "image_generation"}],
+    }
+
+def render_generation_result(api_key, keep_uploads):
+    """Show the result of the background generation, polling until it finishes."""
+    future = st.session_state.get("generation_future")
+    if future is not None:
+        if not future.done():
+            st.info("🔄 Generating your image...")
+            time.sleep(GENERATION_POLL_INTERVAL)
+            st.rerun()
+        
+        # Rerun with the finished future set aside so the generate button is enabled again
+        st.session_state["generation_done"] = st.session_state.pop("generation_future")
+        file_ids = st.session_state.pop("generation_file_ids", [])
+        if not keep_uploads:
+            schedule_file_cleanup(api_key, file_ids)
+        st.rerun()
+    
+    # The result is shown once, then dropped from session state
+    future = st.session_state.pop("generation_done", None)
+    if future is None:
+        return
+    try:
+        image_data, response = future.result()
+    except Exception as e:
+        st.error(f"❌ Error: {str(e)}")
+        st.exception(e)
+        return
+    
+    if image_data:
+        st.success("✅ Image generated successfully!")
+        
+        # Display and save generated images
+        st.subheader("🎨 Generated Images")
+        
+        for i, image_base64 in enumerate(image_data):
+            # Decode and display image
+            image_bytes = pybase64.b64decode(image_base64)
+            
+            # Display image
+            st.image(image_bytes, caption=f"Generated Image {i+1}", use_column_width=True)
+            
+            # Download button
+            st.download_button(
+                label=f"📥 Download Image {i+1}",
+                data=image_bytes,
+                file_name=f"generated_image_{i+1}.png",
+                mime="image/png"
+            )
+    else:
+        st.error("❌ No images were generated")
+        if hasattr(response.output, 'content'):
+            st.text("API Response:")
+            st.text(response.output.content)
 
 def main():
     st.title("🎨 AI Image Generator")
@@ -83,8 +228,35 @@ def main():
             st.info("Please enter your API key in the sidebar or set the OPENAI_API_KEY environment variable.")
             return
         
-        # Set API key for client
-        os.environ["OPENAI_API_KEY"] = api_key
+        client = get_openai_client(api_key)
+        
+        # Batch mode
+        batch_mode = st.toggle(
+            "Batch mode",
+            help="Queue requests and submit them as one batch job. Costs about half as much but results can take up to 24 hours."
+        )
+        
+        # Reference splicing
+        splice_references = st.toggle(
+            "Splice references",
+            help="Combine all reference images into one numbered grid and upload it once. Faster and cheaper, but each image gets less detail."
+        )
+        
+        # Uploaded file cleanup
+        keep_uploads = st.toggle(
+            "Keep uploads",
+            help="Keep uploaded images on OpenAI after generation so repeat runs can reuse them. When off, they are deleted once the result arrives."
+        )
+        
+        # Image preprocessing
+        max_edge = st.slider(
+            "Max image edge (px)",
+            min_value=256,
+            max_value=4096,
+            value=DEFAULT_MAX_EDGE,
+            step=128,
+            help="Larger images are downscaled to this size before upload. Lower values upload faster; higher values keep more detail."
+        )
         
         st.markdown("---")
         st.markdown("### 📋 Instructions")
@@ -121,7 +293,7 @@ def main():
         valid_files = []
         if uploaded_files:
             for i, uploaded_file in enumerate(uploaded_files):
-                is_valid, message = validate_image_file(uploaded_file)
+                is_valid, message = validate_image_file_cached(uploaded_file.name, uploaded_file.size, uploaded_file.type)
                 if is_valid:
                     valid_files.append(uploaded_file)
                     st.success(f"✅ {uploaded_file.name} - {message}")
@@ -131,7 +303,8 @@ def main():
             if not valid_files:
                 st.error("No valid images uploaded. Please upload at least one valid image.")
                 return
-            
+        
+        if valid_files:
             # Display uploaded images
             st.subheader("📷 Uploaded Images")
             cols = st.columns(min(len(valid_files), 3))
@@ -156,7 +329,9 @@ def main():
             st.caption(f"Characters: {len(prompt)}/4000")
         
         # Generate button
-        if st.button("🚀 Generate Image", type="primary", disabled=not (valid_files and prompt)):
+        button_label = "➕ Add to Batch" if batch_mode else "🚀 Generate Image"
+        generating = "generation_future" in st.session_state
+        if st.button(button_label, type="primary", disabled=generating or not (valid_files and prompt)):
             if not valid_files:
                 st.error("Please upload at least one valid image!")
                 return
@@ -166,100 +341,37 @@ def main():
             
             try:
                 with st.spinner("🔄 Processing your request..."):
-                    # Save uploaded files temporarily
-                    temp_files = []
-                    base64_images = []
-                    file_ids = []
+                    if splice_references and len(valid_files) > 1:
+                        # Upload all references as a single composite image
+                        composite_upload = prepare_spliced_upload(valid_files)
+                        file_ids = [asyncio.run(upload_composite_async(api_key, composite_upload))]
+                        request_prompt = f"{prompt}\n\nThe reference images are combined into one grid, numbered in order."
+                    else:
+                        # Prepare and upload all files concurrently, skipping ones already uploaded
+                        file_id_cache = st.session_state.setdefault("file_id_cache", {})
+                        file_ids = asyncio.run(prepare_images_async(api_key, valid_files, max_edge, file_id_cache))
+                        request_prompt = prompt
                     
-                    try:
-                        # Process each uploaded file
-                        for uploaded_file in valid_files:
-                            temp_path = save_uploaded_file(uploaded_file)
-                            temp_files.append(temp_path)
-                            
-                            # Create base64 encoding
-                            base64_image = encode_image(temp_path)
-                            base64_images.append(base64_image)
-                            
-                            # Create file ID for OpenAI
-                            file_id = create_file(temp_path)
-                            file_ids.append(file_id)
-                        
-                        # Prepare content for API call
-                        content = [{"type": "input_text", "text": prompt}]
-                        
-                        # Add images to content
-                        for base64_image in base64_images:
-                            content.append({
-                                "type": "input_image",
-                                "image_url": f"data:image/jpeg;base64,{base64_image}",
-                            })
-                        
-                        for file_id in file_ids:
-                            content.append({
-                                "type": "input_image",
-                                "file_id": file_id,
-                            })
-                        
-                        # Make API call
-                        client = get_openai_client()
-                        response = client.responses.create(
-                            model="gpt-4o",
-                            input=[
-                                {
-                                    "role": "user",
-                                    "content": content,
-                                }
-                            ],
-                            tools=[{"type": "image_generation"}],
-                        )
-                        
-                        # Extract image generation results
-                        image_generation_calls = [
-                            output
-                            for output in response.output
-                            if output.type == "image_generation_call"
-                        ]
-                        
-                        image_data = [output.result for output in image_generation_calls]
-                        
-                        if image_data:
-                            st.success("✅ Image generated successfully!")
-                            
-                            # Display and save generated images
-                            st.subheader("🎨 Generated Images")
-                            
-                            for i, image_base64 in enumerate(image_data):
-                                # Decode and display image
-                                image_bytes = base64.b64decode(image_base64)
-                                
-                                # Display image
-                                st.image(image_bytes, caption=f"Generated Image {i+1}", use_column_width=True)
-                                
-                                # Download button
-                                st.download_button(
-                                    label=f"📥 Download Image {i+1}",
-                                    data=image_bytes,
-                                    file_name=f"generated_image_{i+1}.png",
-                                    mime="image/png"
-                                )
-                        else:
-                            st.error("❌ No images were generated")
-                            if hasattr(response.output, 'content'):
-                                st.text("API Response:")
-                                st.text(response.output.content)
+                    body = build_request_body(request_prompt, file_ids)
                     
-                    finally:
-                        # Clean up temporary files
-                        for temp_file in temp_files:
-                            try:
-                                os.unlink(temp_file)
-                            except:
-                                pass
-                        
+                    if batch_mode:
+                        # Queue the request for the next batch submission
+                        batch_queue = st.session_state.setdefault("batch_queue", [])
+                        custom_id = f"request-{len(batch_queue) + 1}"
+                        batch_queue.append(build_batch_request(custom_id, body))
+                        st.session_state.setdefault("batch_file_ids", set()).update(file_ids)
+                        st.success(f"✅ Added {custom_id} to the batch queue")
+                    else:
+                        # Run the API call in the background so the UI stays responsive
+                        st.session_state["generation_future"] = get_executor().submit(run_generation, client, body)
+                        st.session_state["generation_file_ids"] = file_ids
+            
             except Exception as e:
                 st.error(f"❌ Error: {str(e)}")
                 st.exception(e)
+        
+        render_generation_result(api_key, keep_uploads)
+        render_batch_panel(client, api_key, keep_uploads)
     
     # Footer
     st.markdown("---")
@@ -0,0 +1,341 @@
+"""
+Shared helpers for the AI Image Generator and AI Image Masking Streamlit apps.
+Covers per-session OpenAI clients, upload preparation, background generation,
+uploaded file cleanup and batch mode.
+"""
+
+import asyncio
+import hashlib
+import io
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import httpx
+import pybase64
+import streamlit as st
+from openai import OpenAI, AsyncOpenAI
+from PIL import Image, ImageOps
+
+# Image preprocessing
+DEFAULT_MAX_EDGE = 1024  # pixels
+
+# HTTP connection pool per session
+HTTP_MAX_CONNECTIONS = 20
+HTTP_MAX_KEEPALIVE_CONNECTIONS = 10
+
+# Background generation
+GENERATION_WORKERS = 4
+GENERATION_POLL_INTERVAL = 1  # seconds between checks on a running generation
+
+# Uploaded file cleanup
+CLEANUP_WORKERS = 2
+
+# Batch job polling
+BATCH_POLL_INTERVAL = 30  # minimum seconds between status checks on rerun
+BATCH_TERMINAL_STATUSES = {"completed", "failed", "expired", "cancelled"}
+
+# Initialize OpenAI client
+def get_openai_client(api_key):
+    """Return this session's OpenAI client, creating a new one when the API key changes.
+    
+    Uploaded files and batches belong to the account behind the key, so any
+    state referring to them is dropped and the old client is retired.
+    """
+    if st.session_state.get("openai_api_key") != api_key:
+        old_client = st.session_state.pop("openai_client", None)
+        generation_future = st.session_state.pop("generation_future", None)
+        generation_file_ids = st.session_state.pop("generation_file_ids", [])
+        if old_client is not None:
+            retire_openai_client(
+                st.session_state["openai_api_key"], old_client, generation_future, generation_file_ids
+            )
+        for key in ("file_id_cache", "batch_queue", "batch_file_ids", "batch_id", "batch_status"):
+            st.session_state.pop(key, None)
+        st.session_state["openai_client"] = OpenAI(
+            api_key=api_key,
+            http_client=httpx.Client(limits=httpx.Limits(
+                max_connections=HTTP_MAX_CONNECTIONS,
+                max_keepalive_connections=HTTP_MAX_KEEPALIVE_CONNECTIONS,
+            )),
+        )
+        st.session_state["openai_api_key"] = api_key
+    return st.session_state["openai_client"]
+
+def retire_openai_client(api_key, client, generation_future, file_ids):
+    """Close a replaced client and delete its generation's uploads with the old key.
+    
+    A generation still running on the client would fail if it were closed now,
+    so both steps wait until that generation is done.
+    """
+    cleanup_executor = get_cleanup_executor()
+    
+    def retire(_future=None):
+        client.close()
+        if file_ids:
+            cleanup_executor.submit(asyncio.run, delete_files_async(api_key, file_ids))
+    
+    if generation_future is None:
+        retire()
+    else:
+        generation_future.add_done_callback(retire)
+
+@st.cache_resource
+def get_executor():
+    """Return the thread pool that runs generation requests off the script thread."""
+    return ThreadPoolExecutor(max_workers=GENERATION_WORKERS)
+
+@st.cache_resource
+def get_cleanup_executor():
+    """Return the thread pool that deletes uploaded files, kept apart from long-running generations."""
+    return ThreadPoolExecutor(max_workers=CLEANUP_WORKERS)
+
+def create_async_client(api_key):
+    """Create an async OpenAI client for one event loop run, with SDK retries disabled."""
+    return AsyncOpenAI(
+        api_key=api_key,
+        max_retries=0,
+        http_client=httpx.AsyncClient(limits=httpx.Limits(
+            max_connections=HTTP_MAX_CONNECTIONS,
+            max_keepalive_connections=HTTP_MAX_KEEPALIVE_CONNECTIONS,
+        )),
+    )
+
+@st.cache_data(show_spinner=False)
+def validate_image_file_cached(name, size, mime):
+    """Validate uploaded image file metadata; cached so reruns skip re-validation."""
+    # Check file size (max 20MB for OpenAI)
+    if size > 20 * 1024 * 1024:
+        return False, "File size must be less than 20MB"
+    
+    # Check file type
+    allowed_types = ['image/jpeg', 'image/jpg', 'image/png', 'image/gif', 'image/webp']
+    if mime not in allowed_types:
+        return False, f"File type {mime} not supported. Use: {', '.join(allowed_types)}"
+    
+    return True, "File is valid"
+
+def open_image(uploaded_file):
+    """Open an uploaded file as a PIL image; only the header is read until pixels are needed."""
+    return Image.open(io.BytesIO(uploaded_file.getvalue()))
+
+def prepare_upload(uploaded_file, max_edge=DEFAULT_MAX_EDGE):
+    """Return a (filename, bytes, mime_type) upload tuple, downscaled to fit within max_edge pixels."""
+    with open_image(uploaded_file) as image:
+        # Small enough already, keep the original bytes without decoding them
+        if image.width <= max_edge and image.height <= max_edge:
+            return (uploaded_file.name, uploaded_file.getvalue(), uploaded_file.type)
+        
+        # Re-encoding drops EXIF, so bake the camera orientation into the pixels first
+        image = ImageOps.exif_transpose(image)
+        
+        # Palette and other modes resize poorly, so convert them first
+        if image.mode not in ("RGB", "RGBA", "L", "LA"):
+            image = image.convert("RGBA")
+        image = ImageOps.contain(image, (max_edge, max_edge), Image.LANCZOS)
+        
+        return encode_png_upload(image, f"{Path(uploaded_file.name).stem}.png")
+
+def encode_png_upload(image, filename):
+    """Serialize a PIL image to an optimized PNG upload tuple."""
+    buffer = io.BytesIO()
+    image.save(buffer, format="PNG", optimize=True)
+    return (filename, buffer.getvalue(), "image/png")
+
+def file_cache_key(uploaded_file, max_edge):
+    """Key an uploaded file by a hash of its contents and the resize limit."""
+    digest = hashlib.sha256(uploaded_file.getvalue()).hexdigest()
+    return f"{digest}:{max_edge}"
+
+async def delete_files_async(api_key, file_ids):
+    """Delete uploaded files concurrently; failures are ignored since cleanup is best effort."""
+    async with create_async_client(api_key) as client:
+        await asyncio.gather(
+            *[client.files.delete(file_id) for file_id in file_ids],
+            return_exceptions=True,
+        )
+
+def schedule_file_cleanup(api_key, file_ids):
+    """Delete uploaded files in the background and forget their cached IDs.
+    
+    Files still referenced by a queued or running batch are kept.
+    """
+    batch_file_ids = set(st.session_state.get("batch_file_ids", ()))
+    batch_status = st.session_state.get("batch_status")
+    if batch_status is not None:
+        batch_file_ids |= batch_status.get("file_ids", set())
+    file_ids = [file_id for file_id in file_ids if file_id not in batch_file_ids]
+    if not file_ids:
+        return
+    
+    file_id_cache = st.session_state.get("file_id_cache", {})
+    for cache_key in [key for key, file_id in file_id_cache.items() if file_id in file_ids]:
+        del file_id_cache[cache_key]
+    
+    get_cleanup_executor().submit(asyncio.run, delete_files_async(api_key, file_ids))
+
+def run_generation(client, body):
+    """Call the Responses API and return (image_data, response)."""
+    response = client.responses.create(**body)
+    
+    # Extract image generation results
+    image_data = [
+        output.result
+        for output in response.output
+        if output.type == "image_generation_call"
+    ]
+    return image_data, response
+
+def build_batch_request(custom_id, body):
+    """Wrap a request body as one line of a batch input file."""
+    return {
+        "custom_id": custom_id,
+        "method": "POST",
+        "url": "/v1/responses",
+        "body": body,
+    }
+
+def submit_batch(client, batch_requests):
+    """Upload queued requests as JSONL and submit them as a batch job."""
+    payload = "\n".join(json.dumps(request) for request in batch_requests)
+    batch_file = client.files.create(
+        file=("batch_requests.jsonl", payload.encode("utf-8")),
+        purpose="batch",
+    )
+    return client.batches.create(
+        input_file_id=batch_file.id,
+        endpoint="/v1/responses",
+        completion_window="24h",
+    )
+
+def new_batch_status(batch, file_ids):
+    """Return the status record kept in session state for a newly submitted batch job.
+    
+    file_ids are the uploads its requests reference, kept until the batch is released.
+    """
+    return {"batch": batch, "error": None, "checked_at": time.time(), "file_ids": set(file_ids)}
+
+def refresh_batch_status(client, batch_id, status):
+    """Fetch the batch job's status unless it already finished or was checked recently."""
+    batch = status["batch"]
+    if batch is not None and batch.status in BATCH_TERMINAL_STATUSES:
+        return
+    if time.time() - status["checked_at"] < BATCH_POLL_INTERVAL:
+        return
+    
+    try:
+        status["batch"] = client.batches.retrieve(batch_id)
+    except Exception as e:
+        status["error"] = str(e)
+    else:
+        status["error"] = None
+    status["checked_at"] = time.time()
+
+def release_batch_files(api_key, status, keep_uploads):
+    """Stop holding a finished or forgotten batch's files, deleting them unless uploads are kept.
+    
+    This covers the uploads its requests reference and its JSONL input file.
+    """
+    file_ids = status.pop("file_ids", None)
+    if file_ids is None:
+        return
+    if status["batch"] is not None:
+        file_ids.add(status["batch"].input_file_id)
+    if not keep_uploads:
+        schedule_file_cleanup(api_key, list(file_ids))
+
+def force_batch_refresh():
+    """Button callback that makes the next render fetch the batch status again."""
+    status = st.session_state.get("batch_status")
+    if status is not None:
+        status["checked_at"] = 0
+
+def fetch_batch_images(client, output_file_id):
+    """Download a finished batch's output and extract generated images.
+    
+    Returns a list of (custom_id, image_base64) tuples.
+    """
+    output = client.files.content(output_file_id)
+    images = []
+    for line in output.text.splitlines():
+        record = json.loads(line)
+        body = (record.get("response") or {}).get("body") or {}
+        for item in body.get("output", []):
+            if item.get("type") == "image_generation_call":
+                images.append((record["custom_id"], item["result"]))
+    return images
+
+def render_batch_panel(client, api_key, keep_uploads):
+    """Show queued batch requests and the status of the submitted batch job."""
+    batch_queue = st.session_state.setdefault("batch_queue", [])
+    
+    if batch_queue:
+        st.info(f"📦 {len(batch_queue)} request(s) queued for batch submission")
+        if st.button(f"📤 Submit Batch ({len(batch_queue)})"):
+            try:
+                batch = submit_batch(client, batch_queue)
+            except Exception as e:
+                st.error(f"❌ Error submitting batch: {str(e)}")
+            else:
+                # Only one batch is tracked, so a replaced one is treated as forgotten
+                if "batch_status" in st.session_state:
+                    release_batch_files(api_key, st.session_state["batch_status"], keep_uploads)
+                st.session_state["batch_id"] = batch.id
+                st.session_state["batch_status"] = new_batch_status(batch, st.session_state.pop("batch_file_ids", ()))
+                st.session_state["batch_queue"] = []
+                st.success(f"✅ Batch submitted: {batch.id}")
+    
+    batch_id = st.session_state.get("batch_id")
+    if not batch_id:
+        return
+    
+    # Checked on rerun rather than by a background thread, so nothing polls after the session ends
+    status = st.session_state["batch_status"]
+    refresh_batch_status(client, batch_id, status)
+    batch = status["batch"]
+    if batch is not None and batch.status in BATCH_TERMINAL_STATUSES:
+        release_batch_files(api_key, status, keep_uploads)
+    
+    st.subheader("📦 Batch Job")
+    st.markdown(f"**ID:** `{batch_id}`  \n**Status:** `{batch.status if batch else 'submitted'}`")
+    if status["error"]:
+        st.warning(f"⚠️ Could not check batch status: {status['error']}")
+    
+    refresh_col, clear_col = st.columns(2)
+    with refresh_col:
+        st.button("🔄 Refresh Status", on_click=force_batch_refresh)
+    with clear_col:
+        if st.button("🗑️ Forget Batch"):
+            release_batch_files(api_key, status, keep_uploads)
+            del st.session_state["batch_id"]
+            del st.session_state["batch_status"]
+            st.rerun()
+    
+    if batch is None or batch.status != "completed":
+        return
+    if not batch.output_file_id:
+        st.error("❌ Batch finished without any successful requests")
+        return
+    
+    if st.button("📥 Load Batch Results"):
+        try:
+            batch_images = fetch_batch_images(client, batch.output_file_id)
+        except Exception as e:
+            st.error(f"❌ Error loading batch results: {str(e)}")
+            return
+        
+        if not batch_images:
+            st.error("❌ No images were generated")
+            return
+        
+        for i, (custom_id, image_base64) in enumerate(batch_images):
+            image_bytes = pybase64.b64decode(image_base64)
+            st.image(image_bytes, caption=custom_id, use_column_width=True)
+            st.download_button(
+                label=f"📥 Download {custom_id}",
+                data=image_bytes,
+                file_name=f"{custom_id}_{i+1}.png",
+                mime="image/png",
+                key=f"batch_download_{i}"
+            )